@@ -1,19 +1,22 @@
+from dataclasses import dataclass, field
+from functools import cached_property
 from pathlib import Path
 from types import TracebackType
-from typing import Any, Optional, IO, Literal, Union, Annotated
+from typing import Any, ClassVar, Optional, IO, Literal, Union, Annotated, cast
 
+import io
 import os
 import re
 import time
-import json
 import signal
 
 import subprocess
 import threading
-import queue
 import logging
 
+from concurrent.futures import Future
 from subprocess import TimeoutExpired
+import orjson
 from pydantic import BaseModel, Field
 
 logger = logging.getLogger(__name__)
@@ -23,20 +26,20 @@ class LeanClientError(Exception):
     pass
 
 
-class Position(BaseModel):
+@dataclass(slots=True, frozen=True)
+class Position:
     line: int
     character: int
 
     def __lt__(self, other: "Position") -> bool:
-        if self.line < other.line:
-            return True
-        elif self.line > other.line:
-            return False
-        else:
-            return self.character < other.character
+        return self.line < other.line or (
+            self.line == other.line and self.character < other.character
+        )
 
     def __le__(self, other: "Position") -> bool:
-        return self < other or self == other
+        return self.line < other.line or (
+            self.line == other.line and self.character <= other.character
+        )
 
     def max(self, other: "Position") -> "Position":
         if self < other:
@@ -53,21 +56,21 @@ class Position(BaseModel):
 
     @classmethod
     def from_response(cls, data: Any) -> "Position":
-        return cls(
-            line=data["line"],
-            character=data["character"],
-        )
+        return cls(data["line"], data["character"])
 
 
-class Range(BaseModel):
+@dataclass(slots=True, frozen=True)
+class Range:
     start: Position
     end: Position
 
     def immediately_before(self, other: "Range") -> bool:
-        if self.end.line == other.start.line:
-            return self.end.character == other.start.character
-        if self.end.line + 1 == other.start.line:
-            return other.start.character == 0
+        end = self.end
+        other_start = other.start
+        if end.line == other_start.line:
+            return end.character == other_start.character
+        if end.line + 1 == other_start.line:
+            return other_start.character == 0
         return False
 
     def subsumes(self, other: "Range") -> bool:
@@ -77,16 +80,18 @@ class Range(BaseModel):
         """
         TODO: Need to test this. Sketchy
         """
-        if self.end.line < other.start.line:
+        start, end = self.start, self.end
+        other_start, other_end = other.start, other.end
+        if end.line < other_start.line:
             return False
-        if self.start.line > other.end.line:
+        if start.line > other_end.line:
             return False
         ## our end line is >= their start line
         ## our start line is <= their end line
-        if self.end.line == other.start.line:
-            return self.end.character > other.start.character
-        if self.start.line == other.end.line:
-            return self.start.character < other.end.character
+        if end.line == other_start.line:
+            return end.character > other_start.character
+        if start.line == other_end.line:
+            return start.character < other_end.character
         return True
 
     @property
@@ -102,10 +107,16 @@ class Range(BaseModel):
         Parses a range from a string of the form "line1:col1-line2:col2"
         where line and col are 0-based.
         """
-        match_obj = re.match(r"(\d+):(\d+)-(\d+):(\d+)", s)
-        if match_obj is None:
+        try:
+            start, end = s.split("-", 1)
+            start_line, start_col = start.split(":", 1)
+            end_line, end_col = end.split(":", 1)
+        except ValueError:
+            raise ValueError(f"Invalid range string: {s}") from None
+        parts = (start_line, start_col, end_line, end_col)
+        # int() also accepts signs, whitespace and underscores.
+        if not all(part.isdecimal() for part in parts):
             raise ValueError(f"Invalid range string: {s}")
-        start_line, start_col, end_line, end_col = match_obj.groups()
         return cls(
             start=Position(line=int(start_line), character=int(start_col)),
             end=Position(line=int(end_line), character=int(end_col)),
@@ -113,9 +124,11 @@ class Range(BaseModel):
 
     @classmethod
     def from_response(cls, data: Any) -> "Range":
+        start = data["start"]
+        end = data["end"]
         return cls(
-            start=Position.from_response(data["start"]),
-            end=Position.from_response(data["end"]),
+            Position(start["line"], start["character"]),
+            Position(end["line"], end["character"]),
         )
 
 
@@ -286,7 +299,7 @@ class Decl(BaseModel):
 
     @classmethod
     def from_lean_dict(cls, data: Any) -> "Decl":
-        range = Range.model_validate(data["range"])
+        range = Range.from_response(data["range"])
         content = data["content"]
         info_data = data["info"]
         assert len(info_data) == 1, f"Expected exactly one key in info, got {info_data}"
@@ -345,16 +358,19 @@ class TheoremInfo(BaseModel):
         )
         return cls(
             name=data["name"],
-            range=Range.model_validate(data["range"]),
-            sig_range=Range.model_validate(data["sigRange"]),
-            val_range=Range.model_validate(data["valRange"]),
+            range=Range.from_response(data["range"]),
+            sig_range=Range.from_response(data["sigRange"]),
+            val_range=Range.from_response(data["valRange"]),
             bag_of_tactics=bag_of_tactics,
             num_expands=num_expands,
             samples=samples,
         )
 
 
-class InitializeRequest(BaseModel):
+@dataclass(slots=True, frozen=True)
+class InitializeRequest:
+    METHOD: ClassVar[str] = "initialize"
+
     root_uri: str
 
     @property
@@ -363,29 +379,23 @@ class InitializeRequest(BaseModel):
             "rootUri": self.root_uri,
         }
 
-    @staticmethod
-    def method() -> str:
-        return "initialize"
 
+@dataclass(slots=True, frozen=True)
+class ShutdownRequest:
+    METHOD: ClassVar[str] = "shutdown"
 
-class ShutdownRequest(BaseModel):
     @property
     def params(self) -> dict[Any, Any]:
         return {}
 
-    @staticmethod
-    def method() -> str:
-        return "shutdown"
 
+@dataclass(slots=True, frozen=True)
+class WaitForDiagnosticsRequest:
+    METHOD: ClassVar[str] = "textDocument/waitForDiagnostics"
 
-class WaitForDiagnosticsRequest(BaseModel):
     uri: str
     version: int
 
-    @staticmethod
-    def method() -> str:
-        return "textDocument/waitForDiagnostics"
-
     @property
     def params(self) -> dict[str, Any]:
         return {
@@ -394,14 +404,13 @@ class WaitForDiagnosticsRequest(BaseModel):
         }
 
 
-class PlainGoalRequest(BaseModel):
+@dataclass(slots=True, frozen=True)
+class PlainGoalRequest:
+    METHOD: ClassVar[str] = "$/lean/plainGoal"
+
     uri: str
     position: Position
 
-    @staticmethod
-    def method() -> str:
-        return "$/lean/plainGoal"
-
     @property
     def params(self) -> dict[str, Any]:
         return {
@@ -412,12 +421,11 @@ class PlainGoalRequest(BaseModel):
         }
 
 
-class FindTheoremsRequest(BaseModel):
-    uri: str
+@dataclass(slots=True, frozen=True)
+class FindTheoremsRequest:
+    METHOD: ClassVar[str] = "$/lean/findTheorems"
 
-    @staticmethod
-    def method() -> str:
-        return "$/lean/findTheorems"
+    uri: str
 
     @property
     def params(self) -> dict[str, Any]:
@@ -428,12 +436,11 @@ class FindTheoremsRequest(BaseModel):
         }
 
 
-class FindDeclsRequest(BaseModel):
-    uri: str
+@dataclass(slots=True, frozen=True)
+class FindDeclsRequest:
+    METHOD: ClassVar[str] = "$/lean/findDecls"
 
-    @staticmethod
-    def method() -> str:
-        return "$/lean/findDecls"
+    uri: str
 
     @property
     def params(self) -> dict[str, Any]:
@@ -454,36 +461,33 @@ Request = (
 )
 
 
-class InitializedNotification(BaseModel):
+@dataclass(slots=True, frozen=True)
+class InitializedNotification:
+    METHOD: ClassVar[str] = "initialized"
+
     @property
     def params(self) -> dict[Any, Any]:
         return {}
 
-    @staticmethod
-    def method() -> str:
-        return "initialized"
-
 
-class ExitNotification(BaseModel):
-    @staticmethod
-    def method() -> str:
-        return "exit"
+@dataclass(slots=True, frozen=True)
+class ExitNotification:
+    METHOD: ClassVar[str] = "exit"
 
     @property
     def params(self) -> dict[Any, Any]:
         return {}
 
 
-class DidOpenNotification(BaseModel):
+@dataclass(slots=True, frozen=True)
+class DidOpenNotification:
+    METHOD: ClassVar[str] = "textDocument/didOpen"
+
     uri: str
     text: str
     version: int
     language_id: str
 
-    @staticmethod
-    def method() -> str:
-        return "textDocument/didOpen"
-
     @property
     def params(self) -> dict[str, dict[str, int | str]]:
         return {
@@ -496,22 +500,22 @@ class DidOpenNotification(BaseModel):
         }
 
 
-class ContentChange(BaseModel):
+@dataclass(slots=True, frozen=True)
+class ContentChange:
     text: str
     range: Range
 
 
-class DidChangeNotification(BaseModel):
+@dataclass(frozen=True)
+class DidChangeNotification:
+    METHOD: ClassVar[str] = "textDocument/didChange"
+
     uri: str
     version: int
     text: str
     content_changes: Optional[list[ContentChange]]
 
-    @staticmethod
-    def method() -> str:
-        return "textDocument/didChange"
-
-    @property
+    @cached_property
     def params(self) -> dict[str, Any]:
         if self.content_changes is not None:
             return {
@@ -550,7 +554,8 @@ ClientNotification = (
 )
 
 
-class Diagnostic(BaseModel):
+@dataclass(slots=True, frozen=True)
+class Diagnostic:
     source: str | None
     severity: int
     range: Range
@@ -560,93 +565,119 @@ class Diagnostic(BaseModel):
     @classmethod
     def from_response(cls, json: Any) -> "Diagnostic":
         return cls(
-            source=json.get("source"),
-            severity=json["severity"],
-            range=Range.from_response(json["range"]),
-            message=json["message"],
-            fullRange=Range.from_response(json["fullRange"]),
+            json.get("source"),
+            json["severity"],
+            Range.from_response(json["range"]),
+            json["message"],
+            Range.from_response(json["fullRange"]),
         )
 
 
-class DiagnosticsNotification(BaseModel):
+@dataclass(slots=True, frozen=True)
+class DiagnosticsNotification:
+    """
+    Lean republishes the diagnostics of a file many times while elaborating
+    it, and usually only the last notification is read. The diagnostics are
+    therefore kept as raw JSON and only decoded on first access.
+    """
+
+    METHOD: ClassVar[str] = "textDocument/publishDiagnostics"
+
     version: int
     uri: str
-    diagnostics: list[Diagnostic]
+    raw_diagnostics: list[Any]
+    _diagnostics: Optional[list[Diagnostic]] = field(
+        default=None, init=False, repr=False, compare=False
+    )
 
-    @staticmethod
-    def method() -> str:
-        return "textDocument/publishDiagnostics"
+    @property
+    def diagnostics(self) -> list[Diagnostic]:
+        diagnostics = self._diagnostics
+        if diagnostics is None:
+            from_response = Diagnostic.from_response
+            diagnostics = [from_response(d) for d in self.raw_diagnostics]
+            object.__setattr__(self, "_diagnostics", diagnostics)
+        return diagnostics
 
     @classmethod
     def from_response(cls, json: Any) -> "DiagnosticsNotification":
-        assert json["method"] == cls.method()
-        version: Any = json["params"]["version"]
-        uri: Any = json["params"]["uri"]
-        diagnostics: Any = json["params"]["diagnostics"]
-        return cls(
-            version=version,
-            uri=uri,
-            diagnostics=[Diagnostic.from_response(d) for d in diagnostics],
-        )
+        assert json["method"] == cls.METHOD
+        params = json["params"]
+        return cls(params["version"], params["uri"], params["diagnostics"])
 
 
-class RegisterCapabilityNotification(BaseModel):
-    @staticmethod
-    def method() -> str:
-        return "client/registerCapability"
+@dataclass(slots=True, frozen=True)
+class RegisterCapabilityNotification:
+    METHOD: ClassVar[str] = "client/registerCapability"
 
     @classmethod
     def from_response(cls, json: Any) -> "RegisterCapabilityNotification":
-        assert json["method"] == cls.method()
+        assert json["method"] == cls.METHOD
         return cls()
 
 
-class LeanProgressNotification(BaseModel):
+@dataclass(slots=True, frozen=True)
+class LeanProgressNotification:
+    """
+    Lean sends a progress notification for every step of elaborating a file.
+    Like DiagnosticsNotification, the ranges are kept as raw JSON and only
+    decoded on first access.
+    """
+
+    METHOD: ClassVar[str] = "$/lean/fileProgress"
+
     uri: str
     version: int
-    processing: list[Range]
+    raw_processing: list[Any]
+    _processing: Optional[list[Range]] = field(
+        default=None, init=False, repr=False, compare=False
+    )
 
-    @staticmethod
-    def method() -> str:
-        return "$/lean/fileProgress"
+    @property
+    def processing(self) -> list[Range]:
+        processing = self._processing
+        if processing is None:
+            from_response = Range.from_response
+            processing = [from_response(r["range"]) for r in self.raw_processing]
+            object.__setattr__(self, "_processing", processing)
+        return processing
+
+    @property
+    def done(self) -> bool:
+        """
+        Lean reports an empty processing list once it has finished
+        elaborating this version of the file.
+        """
+        return not self.raw_processing
 
     def __repr__(self) -> str:
         return f"$/lean/fileProgress {self.uri} {self.version} {self.processing}"
 
     @classmethod
     def from_response(cls, json: Any) -> "LeanProgressNotification":
-        assert json["method"] == cls.method()
-        version = json["params"]["textDocument"]["version"]
-        uri = json["params"]["textDocument"]["uri"]
-        return cls(
-            uri=uri,
-            version=version,
-            processing=[
-                Range.from_response(r["range"]) for r in json["params"]["processing"]
-            ],
-        )
+        assert json["method"] == cls.METHOD
+        params = json["params"]
+        text_document = params["textDocument"]
+        return cls(text_document["uri"], text_document["version"], params["processing"])
 
 
-class InlayHintNotification(BaseModel):
-    @staticmethod
-    def method() -> str:
-        return "workspace/inlayHint/refresh"
+@dataclass(slots=True, frozen=True)
+class InlayHintNotification:
+    METHOD: ClassVar[str] = "workspace/inlayHint/refresh"
 
     @classmethod
     def from_response(cls, json: Any) -> "InlayHintNotification":
-        assert json["method"] == cls.method()
+        assert json["method"] == cls.METHOD
         return cls()
 
 
-class SemanticTokensNotification(BaseModel):
-
-    @staticmethod
-    def method() -> str:
-        return "workspace/semanticTokens/refresh"
+@dataclass(slots=True, frozen=True)
+class SemanticTokensNotification:
+    METHOD: ClassVar[str] = "workspace/semanticTokens/refresh"
 
     @classmethod
     def from_response(cls, json: Any) -> "SemanticTokensNotification":
-        assert json["method"] == cls.method()
+        assert json["method"] == cls.METHOD
         return cls()
 
 
@@ -659,7 +690,8 @@ ServerNotification = (
 )
 
 
-class WaitForDiagnosticsResponse(BaseModel):
+@dataclass(slots=True, frozen=True)
+class WaitForDiagnosticsResponse:
     id: int
 
     @classmethod
@@ -668,7 +700,8 @@ class WaitForDiagnosticsResponse(BaseModel):
         return WaitForDiagnosticsResponse(id=id)
 
 
-class DocumentSymbol(BaseModel):
+@dataclass(slots=True, frozen=True)
+class DocumentSymbol:
     name: str
     kind: int
     range: Range
@@ -679,16 +712,17 @@ class DocumentSymbol(BaseModel):
     @classmethod
     def from_response(cls, json: Any) -> "DocumentSymbol":
         return cls(
-            name=json["name"],
-            kind=json["kind"],
-            range=Range.from_response(json["range"]),
-            selectionRange=Range.from_response(json["selectionRange"]),
-            children=[cls.from_response(child) for child in json.get("children", [])],
-            detail=json.get("detail"),
+            json["name"],
+            json["kind"],
+            Range.from_response(json["range"]),
+            Range.from_response(json["selectionRange"]),
+            [cls.from_response(child) for child in json.get("children", [])],
+            json.get("detail"),
         )
 
 
-class FindTheoremsResponse(BaseModel):
+@dataclass(slots=True, frozen=True)
+class FindTheoremsResponse:
     id: int
     theorems: list[TheoremInfo]
 
@@ -702,7 +736,8 @@ class FindTheoremsResponse(BaseModel):
         )
 
 
-class FindDeclsResponse(BaseModel):
+@dataclass(slots=True, frozen=True)
+class FindDeclsResponse:
     id: int
     decls: list[Decl]
 
@@ -716,7 +751,8 @@ class FindDeclsResponse(BaseModel):
         )
 
 
-class InitializedResponse(BaseModel):
+@dataclass(slots=True, frozen=True)
+class InitializedResponse:
     id: int
 
     @classmethod
@@ -725,7 +761,8 @@ class InitializedResponse(BaseModel):
         return cls(id=id)
 
 
-class NoGoalResponse(BaseModel):
+@dataclass(slots=True, frozen=True)
+class NoGoalResponse:
     id: int
 
     @classmethod
@@ -736,7 +773,8 @@ class NoGoalResponse(BaseModel):
         )
 
 
-class PlainGoalResponse(BaseModel):
+@dataclass(slots=True, frozen=True)
+class PlainGoalResponse:
     id: int
     rendered: str
     goals: list[str]
@@ -756,7 +794,8 @@ class PlainGoalResponse(BaseModel):
         )
 
 
-class ShutdownResponse(BaseModel):
+@dataclass(slots=True, frozen=True)
+class ShutdownResponse:
     id: int
 
     @classmethod
@@ -776,62 +815,61 @@ Response = (
 )
 
 
+RESPONSE_TYPES: dict[type[Request], type[Response]] = {
+    InitializeRequest: InitializedResponse,
+    PlainGoalRequest: PlainGoalResponse,
+    ShutdownRequest: ShutdownResponse,
+    WaitForDiagnosticsRequest: WaitForDiagnosticsResponse,
+    FindTheoremsRequest: FindTheoremsResponse,
+    FindDeclsRequest: FindDeclsResponse,
+}
+
+
 def get_response_ty(request: Request) -> type[Response]:
-    match request:
-        case InitializeRequest():
-            return InitializedResponse
-        case PlainGoalRequest():
-            return PlainGoalResponse
-        case ShutdownRequest():
-            return ShutdownResponse
-        case WaitForDiagnosticsRequest():
-            return WaitForDiagnosticsResponse
-        case FindTheoremsRequest():
-            return FindTheoremsResponse
-        case FindDeclsRequest():
-            return FindDeclsResponse
-        case _:
-            raise ValueError(f"Unknown request type: {type(request)}")
-
-
-def read_response(message: Any) -> Response:
-    if "result" in message and "rendered" in message["result"]:
-        return PlainGoalResponse.from_response(message)
-
-    logger.info(f"Reading response: {message}")
-    return InitializedResponse.from_response(message)
+    response_ty = RESPONSE_TYPES.get(type(request))
+    if response_ty is None:
+        raise ValueError(f"Unknown request type: {type(request)}")
+    return response_ty
+
+
+NOTIFICATION_TYPES: dict[str, type[ServerNotification]] = {
+    DiagnosticsNotification.METHOD: DiagnosticsNotification,
+    LeanProgressNotification.METHOD: LeanProgressNotification,
+    RegisterCapabilityNotification.METHOD: RegisterCapabilityNotification,
+    InlayHintNotification.METHOD: InlayHintNotification,
+    SemanticTokensNotification.METHOD: SemanticTokensNotification,
+}
 
 
 def read_notification(message: Any) -> ServerNotification:
     method = message["method"]
-    match method:
-        case "textDocument/publishDiagnostics":
-            return DiagnosticsNotification.from_response(message)
-        case "$/lean/fileProgress":
-            return LeanProgressNotification.from_response(message)
-        case "client/registerCapability":
-            return RegisterCapabilityNotification.from_response(message)
-        case "workspace/inlayHint/refresh":
-            return InlayHintNotification.from_response(message)
-        case "workspace/semanticTokens/refresh":
-            return SemanticTokensNotification.from_response(message)
-        case _:
-            raise ValueError(f"Unknown notification method: {method}")
+    notification_ty = NOTIFICATION_TYPES.get(method)
+    if notification_ty is None:
+        raise ValueError(f"Unknown notification method: {method}")
+    return notification_ty.from_response(message)
 
 
 RPC_VERSION = "2.0"
 
+# Size of the buffers used for the server's stdin and stdout pipes.
+PIPE_BUFFER_SIZE = 64 * 1024
+
 
-def read_exactly(stream: IO[bytes], n: int) -> bytes:
-    data = bytearray()
-    while len(data) < n:
-        chunk = stream.read(n - len(data))
-        if not chunk:  # EOF
+def read_exactly(stream: io.BufferedIOBase, n: int) -> bytearray:
+    data = bytearray(n)
+    view = memoryview(data)
+    pos = 0
+    while pos < n:
+        num_read = stream.readinto(view[pos:])
+        if not num_read:  # EOF
             break
-        data.extend(chunk)
-    if len(data) < n:
-        raise EOFError(f"Expected {n} bytes, got {len(data)} bytes before EOF.")
-    return bytes(data)
+        pos += num_read
+    if pos < n:
+        raise EOFError(f"Expected {n} bytes, got {pos} bytes before EOF.")
+    return data
+
+
+CONTENT_LENGTH_RE = re.compile(rb"Content-Length:\s*(\d+)")
 
 
 def read_lsp_message_header(stream: IO[bytes]) -> int:
@@ -841,23 +879,30 @@ def read_lsp_message_header(stream: IO[bytes]) -> int:
     """
     content_length = None
     while True:
-        line = stream.readline().decode("utf-8")
-        if not line.strip() and content_length:  # empty line: end of headers
-            break
-        match = re.match(r"Content-Length:\s*(\d+)", line)
-        if match:
-            (content_length_str,) = match.groups()
-            content_length = int(content_length_str)
-        else:
-            # logger.info(f"Skipping non-Content-Length header: {line.strip()}")
+        line = stream.readline()
+        if not line:
+            raise EOFError("Stream closed while reading LSP message header.")
+        if line == b"\r\n" or line == b"\n":  # empty line: end of headers
+            if content_length is not None:
+                break
             continue
-    # if content_length is None:
-    #     raise ValueError(
-    #         f"No Content-Length header found. Got headers:\n{line}; {len(line)}"
-    #     )
+        match = CONTENT_LENGTH_RE.match(line)
+        if match:
+            content_length = int(match.group(1))
     return content_length
 
 
+def claim_future(future: "Future[Response]") -> bool:
+    """
+    Marks a pending request's future as running before it is resolved.
+    Returns False if it can't be resolved: the caller of send_request_async
+    may have cancelled it, or resolved it themselves.
+    """
+    if future.done() and not future.cancelled():
+        return False
+    return future.set_running_or_notify_cancel()
+
+
 def get_server_path(workspace: Path) -> Path:
     return (
         workspace
@@ -909,43 +954,133 @@ class LeanClient:
             cwd=work_dir,
             start_new_session=True,
         )
+        # The pipes are opened unbuffered so that shutdown can close them while
+        # the reader threads are blocked on them. Writes are buffered here so
+        # that each message is written with a single flush.
+        assert self.process.stdin is not None, "Process stdin is none."
+        self._stdin = io.BufferedWriter(
+            cast(io.RawIOBase, self.process.stdin), buffer_size=PIPE_BUFFER_SIZE
+        )
         self.request_id = 0
         self.lock = threading.Lock()
         self._shutting_down = False
+        self.managed_files: dict[str, int] = {}  # uri -> version
+        self.latest_diagnostics: dict[str, DiagnosticsNotification] = {}
+        # uri -> latest version Lean has finished processing.
+        self.processed_versions: dict[str, int] = {}
+        # Notified by the stdout reader whenever latest_diagnostics or
+        # processed_versions changes.
+        self._diagnostics_cv = threading.Condition()
+        self._registered = threading.Event()
+        # Outstanding requests by id: the expected response type and the
+        # future the reader thread resolves with the parsed response.
+        self._pending: dict[int, tuple[type[Response], Future[Response]]] = {}
+        # Set under self.lock once the stdout reader has exited.
+        self._reader_closed = False
         self._stderr_thread = threading.Thread(
             target=self._read_stderr_loop, daemon=True
         )
         self._stderr_thread.start()
-        self._msg_queue: queue.Queue[Any] = queue.Queue()
         self._stdout_thread = threading.Thread(
             target=self._read_stdout_loop, daemon=True
         )
         self._stdout_thread.start()
-        self.managed_files: dict[str, int] = {}  # uri -> version
-        self.latest_diagnostics: dict[str, DiagnosticsNotification] = {}
 
     def _read_stderr_loop(self):
         assert self.process.stderr is not None, "Process stderr is none."
         for line in self.process.stderr:
-            logger.info(
-                f"Lean stderr: {line.decode('utf-8', errors='replace').rstrip()}"
-            )
+            if logger.isEnabledFor(logging.INFO):
+                logger.info(
+                    "Lean stderr: %s", line.decode("utf-8", errors="replace").rstrip()
+                )
 
     def _read_stdout_loop(self):
         assert self.process.stdout is not None, "Process stdout is none."
+        # The pipe is opened unbuffered (bufsize=0), so buffer reads here
+        # rather than paying a syscall per byte in readline.
+        stdout = io.BufferedReader(
+            cast(io.RawIOBase, self.process.stdout),
+            buffer_size=PIPE_BUFFER_SIZE,
+        )
         while True:
             try:
-                content_length = read_lsp_message_header(self.process.stdout)
-                response = read_exactly(self.process.stdout, content_length)
-                message = json.loads(response)
-                self._msg_queue.put(message)
+                content_length = read_lsp_message_header(stdout)
+                response = stdout.read(content_length)
+                if len(response) < content_length:
+                    response += read_exactly(stdout, content_length - len(response))
+                message = orjson.loads(response)
+                self._handle_message(message)
             except Exception as e:
                 if self._shutting_down:
                     logger.info("Lean stdout closed, exiting read loop.")
                 else:
                     logger.exception(f"Error reading from stdout: {e}")
+                self._fail_pending(LeanClientError("Lean server stdout closed."))
                 return
 
+    def _handle_message(self, message: Any):
+        """
+        Dispatches a message from the server. Runs on the stdout reader thread.
+        """
+        if "method" in message:
+            try:
+                notification = read_notification(message)
+            except ValueError as e:
+                logger.warning(str(e))
+                return
+            if isinstance(notification, DiagnosticsNotification):
+                logger.debug("Adding diagnostics: %s", notification)
+                with self._diagnostics_cv:
+                    self.latest_diagnostics[notification.uri] = notification
+                    self._diagnostics_cv.notify_all()
+            elif isinstance(notification, LeanProgressNotification):
+                if notification.done:
+                    with self._diagnostics_cv:
+                        self.processed_versions[notification.uri] = notification.version
+                        self._diagnostics_cv.notify_all()
+            elif isinstance(notification, RegisterCapabilityNotification):
+                self._registered.set()
+        elif "id" in message:
+            pending = self._pending.pop(message["id"], None)
+            if pending is None:
+                logger.warning(
+                    f"Received response with unexpected id {message['id']}. Ignoring."
+                )
+                return
+            response_ty, future = pending
+            if not claim_future(future):
+                return
+            if "error" in message:
+                error = message["error"]
+                logger.error(
+                    f"Received error response: {error['message']}; Code {error['code']}"
+                )
+                future.set_exception(
+                    LeanClientError(f"Error response received: {error['message']}")
+                )
+                return
+            try:
+                future.set_result(response_ty.from_response(message))
+            except Exception as e:
+                future.set_exception(e)
+        else:
+            logger.warning(
+                f"Received message that is neither notification nor response: {message}"
+            )
+
+    def _fail_pending(self, error: Exception):
+        """
+        Fails the outstanding requests once the reader has stopped. Requests
+        sent after this fail immediately, since nothing would answer them.
+        """
+        with self.lock:
+            self._reader_closed = True
+            pending = list(self._pending.values())
+            self._pending.clear()
+        for _, future in pending:
+            if claim_future(future):
+                future.set_exception(error)
+
     def open_file(self, uri: str, text: str, language_id: str = "lean4"):
         assert uri not in self.managed_files, f"File {uri} is already open."
         self.managed_files[uri] = 1
@@ -964,16 +1099,21 @@ class LeanClient:
         """
         Returns the current version of the file.
         """
-        assert uri in self.managed_files, f"File {uri} is not open."
-        return self.managed_files[uri]
+        version = self.managed_files.get(uri)
+        if version is None:
+            raise LeanClientError(f"File {uri} is not open.")
+        return version
 
     def change_file(self, uri: str, new_text: str) -> int:
         """
         Updates the file for the lsp and returns the new version number.
         """
-        assert uri in self.managed_files, f"File {uri} is not open."
-        new_version = self.managed_files[uri] + 1
-        self.managed_files[uri] = new_version
+        managed_files = self.managed_files
+        version = managed_files.get(uri)
+        if version is None:
+            raise LeanClientError(f"File {uri} is not open.")
+        new_version = version + 1
+        managed_files[uri] = new_version
         change_notification = DidChangeNotification(
             uri=uri,
             text=new_text,
@@ -988,84 +1128,61 @@ class LeanClient:
     ) -> Optional[DiagnosticsNotification]:
         """
         Returns the latest diagnostics and version for the given file, if any.
+        Waits up to `timeout` seconds for the first diagnostics of the file.
         """
-        self.update_diagnostics(timeout)
-        return self.latest_diagnostics.get(uri, None)
+        with self._diagnostics_cv:
+            self._diagnostics_cv.wait_for(
+                lambda: uri in self.latest_diagnostics, timeout=timeout
+            )
+            return self.latest_diagnostics.get(uri, None)
 
     def wait_for_register(self, timeout: float = 5.0):
-        start = time.time()
-        while True:
-            message = self.read_message(response_ty=None, block=False, timeout=timeout)
-            if isinstance(message, RegisterCapabilityNotification):
-                return
-            if time.time() - start > timeout:
-                raise TimeoutError(
-                    "Timed out waiting for register capability notification."
-                )
+        if not self._registered.wait(timeout):
+            raise TimeoutError(
+                "Timed out waiting for register capability notification."
+            )
 
     def wait_for_diagnostics(
-        self, uri: str, timeout: float = 5.0
+        self, uri: str, timeout: float = 5.0, version: Optional[int] = None
     ) -> DiagnosticsNotification:
-        logger.info(
-            f"Waiting for diagnostics for {uri} version {self.managed_files.get(uri, 'N/A')}"
-        )
-        assert uri in self.managed_files, f"File {uri} is not open."
-        total_wait = 0.0
-        wait_interval = 0.1
-        while total_wait < timeout:
-            self.update_diagnostics(timeout=wait_interval)
-            if uri in self.latest_diagnostics:
-                diag = self.latest_diagnostics[uri]
-                if diag.version == self.managed_files[uri]:
-                    return diag
-            time.sleep(wait_interval)
-            total_wait += wait_interval
-        raise TimeoutError(
-            f"Timed out waiting for diagnostics for {uri} version {self.managed_files[uri]}"
-        )
+        """
+        Waits until Lean has finished processing the given version of the file
+        (the current version by default) and has published diagnostics for it.
+        Unlike WaitForDiagnosticsRequest, this needs no round trip to the
+        server: it is woken by the notifications themselves.
+        """
+        if version is None:
+            version = self.file_version(uri)
+        logger.info("Waiting for diagnostics for %s version %d", uri, version)
+        latest_diagnostics = self.latest_diagnostics
+        processed_versions = self.processed_versions
+
+        def has_version() -> bool:
+            diag = latest_diagnostics.get(uri)
+            return (
+                diag is not None
+                and diag.version == version
+                and processed_versions.get(uri, 0) >= version
+            )
 
-    def read_message(
-        self, response_ty: Optional[type[Response]], block: bool, timeout: float
-    ) -> Optional[ServerNotification | Response]:
-        try:
-            msg = self._msg_queue.get(timeout=timeout, block=block)
-            if "method" in msg:
-                return read_notification(msg)
-            elif response_ty is not None and "id" in msg:
-                if "error" in msg:
-                    logger.error(
-                        f"Received error response: {msg['error']['message']}; Code {msg['error']['code']}"
-                    )
-                    raise LeanClientError(
-                        f"Error response received: {msg['error']['message']}"
-                    )
-                return response_ty.from_response(msg)
-            else:
-                logger.warning(
-                    f"Received message that is neither notification nor response: {msg}"
+        with self._diagnostics_cv:
+            if not self._diagnostics_cv.wait_for(has_version, timeout=timeout):
+                raise TimeoutError(
+                    f"Timed out waiting for diagnostics for {uri} version {version}"
                 )
-                return None
-        except queue.Empty:
-            return None
-
-    def update_diagnostics(self, timeout: float):
-        while True:
-            message = self.read_message(response_ty=None, block=False, timeout=timeout)
-            if message is not None:
-                logger.debug(f"Read message: {message}")
-            if message is None:
-                break
-            if isinstance(message, DiagnosticsNotification):
-                logger.info(f"Adding diagnostics: {message}")
-                self.latest_diagnostics[message.uri] = message
+            return latest_diagnostics[uri]
 
     def shutdown(self):
         logger.info("Shutting down Lean client...")
-        self.send_request(ShutdownRequest(), timeout=60.0)
-        self.send_notification(ExitNotification())
+        try:
+            self.send_request(ShutdownRequest(), timeout=60.0)
+            self.send_notification(ExitNotification())
+        except (LeanClientError, OSError) as e:
+            # The server is already gone; still clean up its process group.
+            logger.warning("Lean server did not shut down cleanly: %s", e)
         self._shutting_down = True
-        if self.process.stdin is not None:
-            self.process.stdin.close()
+        with self.lock:
+            self._stdin.close()
         if self.process.stdout is not None:
             self.process.stdout.close()
         if self.process.stderr is not None:
@@ -1100,61 +1217,68 @@ class LeanClient:
         )
         return new_client
 
-    def send_str(self, message: str):
-        message_bytes = message.encode("utf-8")
-        content_length = len(message_bytes)
-        full_message = f"Content-Length: {content_length}\r\n\r\n{message}".encode(
-            "utf-8"
-        )
-        with self.lock:
-            assert self.process.stdin is not None, "Process stdin is none."
+    def send_str(self, message_bytes: bytes):
+        header = b"Content-Length: %d\r\n\r\n" % len(message_bytes)
+        if logger.isEnabledFor(logging.DEBUG):
             logger.debug("=== Sending message to Lean stdin ===")
-            logger.debug(full_message.decode("utf-8", errors="replace"))
-            self.process.stdin.write(full_message)
-            self.process.stdin.flush()
+            logger.debug(message_bytes.decode("utf-8", errors="replace"))
+        with self.lock:
+            self._stdin.write(header)
+            self._stdin.write(message_bytes)
+            self._stdin.flush()
 
     def send_notification(self, notification: ClientNotification):
         notification_dict: dict[Any, Any] = {
             "jsonrpc": RPC_VERSION,
-            "method": notification.method(),
+            "method": notification.METHOD,
             "params": notification.params,
         }
-        message = json.dumps(notification_dict)
-        self.send_str(message)
+        message_bytes = orjson.dumps(notification_dict)
+        self.send_str(message_bytes)
 
-    def send_request(self, request: Request, timeout: float = 10.0) -> Response:
-        """
-        Potential issue: What if we get a notification in the middle of a request?
-        """
-        self.request_id += 1
+    def _send_request(self, request: Request) -> tuple[int, "Future[Response]"]:
+        response_ty = get_response_ty(request)
+        future: Future[Response] = Future()
+        with self.lock:
+            if self._reader_closed:
+                raise LeanClientError(
+                    f"Lean server stdout is closed; cannot send {request.METHOD}."
+                )
+            self.request_id += 1
+            request_id = self.request_id
+            self._pending[request_id] = (response_ty, future)
         request_dict: dict[Any, Any] = {
             "jsonrpc": RPC_VERSION,
-            "id": self.request_id,
-            "method": request.method(),
+            "id": request_id,
+            "method": request.METHOD,
             "params": request.params,
         }
-        message = json.dumps(request_dict)
-        self.send_str(message)
+        message_bytes = orjson.dumps(request_dict)
+        self.send_str(message_bytes)
+        return request_id, future
 
-        start = time.time()
-        response_ty = get_response_ty(request)
-        while True:
-            response_data = self.read_message(
-                response_ty=response_ty, block=True, timeout=timeout
-            )
-            if isinstance(response_data, DiagnosticsNotification):
-                self.latest_diagnostics[response_data.uri] = response_data
-            if isinstance(response_data, Response):
-                if response_data.id != self.request_id:
-                    logger.warning(
-                        f"Received response with id {response_data.id} but expected {self.request_id}. Ignoring."
-                    )
-                    continue
-                return response_data
-            if time.time() - start > timeout:
-                raise TimeoutError(
-                    f"Timed out waiting for response to {request.method()}"
-                )
+    def send_request_async(self, request: Request) -> "Future[Response]":
+        """
+        Sends a request without waiting for its response. The returned future
+        is resolved by the stdout reader thread, so many requests can be in
+        flight at once. Its done callbacks also run on that thread and must
+        not block on the client.
+        """
+        _, future = self._send_request(request)
+        return future
+
+    def send_request(self, request: Request, timeout: float = 10.0) -> Response:
+        """
+        Sends a request and blocks until the stdout reader thread resolves
+        its response. Notifications that arrive in the meantime are handled
+        by the reader thread.
+        """
+        request_id, future = self._send_request(request)
+        try:
+            return future.result(timeout=timeout)
+        except TimeoutError:
+            self._pending.pop(request_id, None)
+            raise TimeoutError(f"Timed out waiting for response to {request.METHOD}")
 
     @classmethod
     def start(
@@ -3,11 +3,13 @@ A harness for a proof search.
 """
 
 import types
+from dataclasses import dataclass
+from functools import cached_property
 from typing import Optional
 
 import logging
 import threading
-from pydantic import BaseModel
+from concurrent.futures import Future, ThreadPoolExecutor
 from pathlib import Path
 
 from lean_client.client import (
@@ -17,6 +19,7 @@ from lean_client.client import (
     Diagnostic,
     WaitForDiagnosticsRequest,
     WaitForDiagnosticsResponse,
+    Response,
     TheoremInfo,
     ProofSampleArguments,
 )
@@ -27,23 +30,48 @@ from lean_client.instruments import (
     CommandError,
 )
 
-from lean_client.lsp_utils import get_range_str, parse_lean_docstring, str_to_pos
+from lean_client.lsp_utils import (
+    build_line_offsets,
+    get_range_str,
+    get_range_str_indexed,
+    parse_lean_docstring,
+    str_end_pos,
+)
 
 logger = logging.getLogger(__name__)
 
 
-class ProofSucceededResult(BaseModel):
+@dataclass(slots=True)
+class ProofSucceededResult:
     pass
 
 
-class ProofFailedResult(BaseModel):
+@dataclass(slots=True)
+class ProofFailedResult:
     diagnostics: list[Diagnostic]
 
 
 STARTUP_LOCK = threading.Semaphore(8)
 
-# Map of workspace path to LeanClient instance.
-CLIENT_MAP: dict[Path, LeanClient] = {}
+# How long to wait for diagnostics to be pushed by the server before falling
+# back to an explicit WaitForDiagnosticsRequest.
+DIAGNOSTICS_WAIT_TIMEOUT = 0.5
+
+# Map of workspace path to its LeanClient. The future is published before the
+# client starts, so that startups on different workspaces don't wait on
+# CLIENT_MAP_LOCK and harnesses on the same workspace wait for the one start.
+CLIENT_MAP: dict[Path, Future[LeanClient]] = {}
+
+# Map of workspace path to the number of Harness instances using its client.
+CLIENT_REFCOUNTS: dict[Path, int] = {}
+
+# Map of workspace path to a lock per open document of its client. A check
+# holds the lock of its document from changing the file until it has read the
+# diagnostics, so that harnesses on the same file don't see each other's proofs.
+DOCUMENT_LOCKS: dict[Path, dict[str, threading.Lock]] = {}
+
+# Guards CLIENT_MAP, CLIENT_REFCOUNTS and DOCUMENT_LOCKS.
+CLIENT_MAP_LOCK = threading.Lock()
 
 # Set of open file uris.
 FILE_SET: set[Path] = set()
@@ -69,15 +97,17 @@ class Harness:
             clear_file_proofs: Whether to clear the proofs of all theorems in the file before attempting to prove the target theorem.
             timeout: The timeout (in seconds) for Initial Diagnostics request.
 
-        TODO:
-        - It might be better to pass in a LeanClient instance instead of creating one here.
-        - Then the same LeanClient could be shared across multiple Harness instances.
-        - This approach is simpler for now.
+        Harness instances on the same workspace share one LeanClient, which is
+        shut down when the last of them exits. Instances on the same file also
+        share the open document, so their proof checks run one at a time.
         """
         assert workspace.exists()
         assert (workspace / relfile).exists()
         self.workspace = workspace.resolve()
         self.relfile = relfile
+        self._file = (self.workspace / self.relfile).resolve()
+        self._workspace_uri = self.workspace.as_uri()
+        self._file_uri = self._file.as_uri()
 
         if clear_file_proofs:
             raise NotImplementedError(
@@ -86,26 +116,33 @@ class Harness:
 
         self.theorem_name = theorem_name
 
-        logger.info(f"Checking that workspace {self.workspace} supports instruments...")
+        logger.info(
+            "Checking that workspace %s supports instruments...", self.workspace
+        )
         with STARTUP_LOCK:
             heartbeat = HeartbeatCommand(workspace=self.workspace)
-            if heartbeat.run():
+            info_command = TheoremInfoCommand(
+                workspace=self.workspace,
+                rel_filepath=self.relfile,
+                samples=proof_sample_args or [],
+            )
+            # The two commands are independent lake invocations, so overlap
+            # them. A workspace without instruments makes both fail, and the
+            # heartbeat result decides which error is reported.
+            with ThreadPoolExecutor(max_workers=2) as executor:
+                heartbeat_future = executor.submit(heartbeat.run)
                 logger.info(
-                    f"Finding theorem info for {theorem_name} in file {self.file}..."
-                )
-                info_command = TheoremInfoCommand(
-                    workspace=self.workspace,
-                    rel_filepath=self.relfile,
-                    samples=proof_sample_args or [],
+                    "Finding theorem info for %s in file %s...", theorem_name, self.file
                 )
-                theorem_infos = info_command.run()
+                info_future = executor.submit(info_command.run_indexed)
+                heartbeat_ok = heartbeat_future.result()
+                theorem_infos = info_future.result()
+            if heartbeat_ok:
                 if isinstance(theorem_infos, CommandError):
                     raise RuntimeError(
                         f"Failed to get theorem info for {theorem_name} in file {self.file}: {theorem_infos}"
                     )
-                matching_infos = [
-                    ti for ti in theorem_infos if ti.name == self.theorem_name
-                ]
+                matching_infos = theorem_infos.get(self.theorem_name, [])
                 if len(matching_infos) != 1:
                     raise RuntimeError(
                         f"Expected exactly one theorem info for {theorem_name} in file {self.file}, but found {len(matching_infos)}"
@@ -129,31 +166,45 @@ class Harness:
                 raise NotImplementedError(
                     "Not yet implemented: keeping the original proof."
                 )
-
-            self.client = LeanClient.start(self.workspace, timeout=timeout)
-            self.client.open_file(self.file_uri, self.orig_file_contents)
-            response = self.client.send_request(
-                WaitForDiagnosticsRequest(
-                    uri=self.file_uri, version=self.client.file_version(self.file_uri)
-                ),
-                timeout=timeout,
+            # The file contents and theorem info never change after this point.
+            self._line_offsets = build_line_offsets(self.orig_file_contents)
+            self._file_prefix = self.get_orig_range_str(
+                Range(
+                    start=Position(line=0, character=0),
+                    end=self.theorem_info.sig_range.end,
+                )
             )
-            assert isinstance(response, WaitForDiagnosticsResponse)
 
-    @property
+            self.client = self.acquire_client(timeout)
+            try:
+                with self._document_lock:
+                    if self.client.is_open(self.file_uri):
+                        version = self.client.change_file(
+                            self.file_uri, self.orig_file_contents
+                        )
+                    else:
+                        self.client.open_file(self.file_uri, self.orig_file_contents)
+                        version = 1
+                    self.wait_for_diagnostics(version, timeout)
+            except BaseException:
+                self.release_client()
+                raise
+
+    @cached_property
     def no_docstring_info(self) -> TheoremInfo:
+        """
+        The theorem info with its range starting after the theorem's docstring.
+        Computed once, since the file contents and theorem info are fixed.
+        """
         theorem_signature = self.get_full_theorem_signature()
         theorem_docstring = parse_lean_docstring(theorem_signature)
         if theorem_docstring is None:
             return self.theorem_info
         else:
             assert theorem_signature.startswith(theorem_docstring)
-            thm_start_range = Range(
-                start=Position(line=0, character=0), end=self.theorem_info.range.start
+            new_start_pos = str_end_pos(
+                self.theorem_info.range.start, theorem_docstring
             )
-            to_theorem_start = get_range_str(self.orig_file_contents, thm_start_range)
-            prefix_with_docstring = to_theorem_start + theorem_docstring
-            new_start_pos = str_to_pos(prefix_with_docstring)
             assert (
                 self.theorem_info.range.start
                 <= new_start_pos
@@ -169,15 +220,15 @@ class Harness:
 
     @property
     def file(self) -> Path:
-        return (self.workspace / self.relfile).resolve()
+        return self._file
 
     @property
     def workspace_uri(self) -> str:
-        return self.workspace.resolve().as_uri()
+        return self._workspace_uri
 
     @property
     def file_uri(self) -> str:
-        return (self.workspace / self.relfile).resolve().as_uri()
+        return self._file_uri
 
     def get_prefix_core(self, contents: str) -> str:
         prefix_range = Range(
@@ -187,12 +238,18 @@ class Harness:
         prefix = get_range_str(contents, prefix_range)
         return prefix
 
+    def get_orig_range_str(self, r: Range) -> str:
+        """
+        Get the text of the given range of the original file contents.
+        """
+        return get_range_str_indexed(self.orig_file_contents, self._line_offsets, r)
+
     def get_file_prefix(self) -> str:
         """
         Get the preifx of the file, including the theorem statement, up to
         the start of the proof.
         """
-        return self.get_prefix_core(self.orig_file_contents)
+        return self._file_prefix
 
     def get_full_theorem_signature(self) -> str:
         """
@@ -204,7 +261,7 @@ class Harness:
         full_sig_range = Range(
             start=self.theorem_info.range.start, end=self.theorem_info.sig_range.end
         )
-        return get_range_str(self.orig_file_contents, full_sig_range)
+        return self.get_orig_range_str(full_sig_range)
 
     def get_type_signature(self) -> str:
         """
@@ -213,54 +270,193 @@ class Harness:
         """
         # The sig_range begins at the _type signature_ and not the beginning of
         # the declaration.
-        return get_range_str(self.orig_file_contents, self.theorem_info.sig_range)
+        return self.get_orig_range_str(self.theorem_info.sig_range)
 
     def get_error_diagnostics(self) -> list[Diagnostic]:
         latest_diags = self.client.latest_diagnostics[self.file_uri].diagnostics
-        proof_diagnostics = [
-            d for d in latest_diags if self.theorem_info.range.start <= d.range.end
-        ]
-        proof_error_diagnostics = [d for d in proof_diagnostics if d.severity == 1]
-        return proof_error_diagnostics
+        start = self.theorem_info.range.start
+        return [d for d in latest_diags if d.severity == 1 and start <= d.range.end]
+
+    def acquire_client(self, timeout: float) -> LeanClient:
+        """
+        Returns the shared client for the workspace, starting it if needed.
+        """
+        with CLIENT_MAP_LOCK:
+            client_future = CLIENT_MAP.get(self.workspace)
+            starting = client_future is None
+            if client_future is None:
+                client_future = Future[LeanClient]()
+                CLIENT_MAP[self.workspace] = client_future
+                DOCUMENT_LOCKS[self.workspace] = {}
+            CLIENT_REFCOUNTS[self.workspace] = (
+                CLIENT_REFCOUNTS.get(self.workspace, 0) + 1
+            )
+            self._document_lock = DOCUMENT_LOCKS[self.workspace].setdefault(
+                self.file_uri, threading.Lock()
+            )
+        if starting:
+            try:
+                client_future.set_result(
+                    LeanClient.start(self.workspace, timeout=timeout)
+                )
+            except BaseException as e:
+                client_future.set_exception(e)
+        try:
+            return client_future.result()
+        except BaseException:
+            self.release_client()
+            raise
+
+    def release_client(self):
+        """
+        Releases the shared client, shutting it down if this was its last user.
+        """
+        with CLIENT_MAP_LOCK:
+            refcount = CLIENT_REFCOUNTS[self.workspace] - 1
+            if refcount > 0:
+                CLIENT_REFCOUNTS[self.workspace] = refcount
+                return
+            del CLIENT_REFCOUNTS[self.workspace]
+            del DOCUMENT_LOCKS[self.workspace]
+            client_future = CLIENT_MAP.pop(self.workspace)
+        # A client that failed to start has nothing to shut down.
+        if client_future.exception() is None:
+            client_future.result().shutdown()
+
+    def wait_for_diagnostics(self, version: int, timeout: float):
+        """
+        Waits for the diagnostics of the given version of the file. Diagnostics
+        pushed by the server usually arrive well before the server would answer
+        a WaitForDiagnosticsRequest, so only fall back to the request if they
+        don't show up quickly.
+        """
+        try:
+            self.client.wait_for_diagnostics(
+                self.file_uri,
+                timeout=min(DIAGNOSTICS_WAIT_TIMEOUT, timeout),
+                version=version,
+            )
+        except TimeoutError:
+            response = self.client.send_request(
+                WaitForDiagnosticsRequest(uri=self.file_uri, version=version),
+                timeout,
+            )
+            assert isinstance(response, WaitForDiagnosticsResponse)
 
     def check_proof(
         self, proof: str, timeout: float = 10.0
     ) -> ProofSucceededResult | ProofFailedResult:
         new_file_contents = self.get_file_prefix() + proof
-        self.client.change_file(self.file_uri, new_file_contents)
-        wait_response = self.client.send_request(
-            WaitForDiagnosticsRequest(
-                uri=self.file_uri, version=self.client.managed_files[self.file_uri]
-            ),
-            timeout,
-        )
-        assert isinstance(wait_response, WaitForDiagnosticsResponse)
-        diagnostics = self.client.latest_diagnostics[self.file_uri].diagnostics
+        with self._document_lock:
+            version = self.client.change_file(self.file_uri, new_file_contents)
+            self.wait_for_diagnostics(version, timeout)
+            latest = self.client.latest_diagnostics[self.file_uri]
+        if latest.version != version:
+            raise RuntimeError(f"File {self.file_uri} changed while checking a proof.")
+        return self.get_proof_result(latest.diagnostics)
+
+    def check_proof_async(
+        self, proof: str
+    ) -> Future[ProofSucceededResult | ProofFailedResult]:
+        """
+        Like check_proof, but returns a future instead of waiting for the
+        diagnostics. Harnesses on different files of a shared client can have
+        checks in flight at the same time; a check on a file with a check in
+        flight blocks until that check is resolved.
+
+        The future is resolved on the client's stdout reader thread, so
+        callbacks added with add_done_callback run there. They must not make
+        blocking calls on the client (e.g. check_proof), which would deadlock
+        it waiting for a response only that thread can read.
+        """
+        new_file_contents = self.get_file_prefix() + proof
+        # Released by on_wait_done once the diagnostics have been read.
+        self._document_lock.acquire()
+        try:
+            version = self.client.change_file(self.file_uri, new_file_contents)
+            wait_future = self.client.send_request_async(
+                WaitForDiagnosticsRequest(uri=self.file_uri, version=version)
+            )
+        except BaseException:
+            self._document_lock.release()
+            raise
+        result: Future[ProofSucceededResult | ProofFailedResult] = Future()
+
+        def on_wait_done(wait_future: Future[Response]):
+            # Runs on the client's stdout reader thread, which has already
+            # handled the diagnostics published before the response.
+            try:
+                try:
+                    response = wait_future.result()
+                    assert isinstance(response, WaitForDiagnosticsResponse)
+                    latest = self.client.latest_diagnostics[self.file_uri]
+                finally:
+                    # Before resolving, so callbacks can check the file again.
+                    self._document_lock.release()
+                if latest.version != version:
+                    raise RuntimeError(
+                        f"File {self.file_uri} changed while checking a proof."
+                    )
+                result.set_result(self.get_proof_result(latest.diagnostics))
+            except Exception as e:
+                result.set_exception(e)
+
+        wait_future.add_done_callback(on_wait_done)
+        return result
+
+    def get_proof_result(
+        self, diagnostics: list[Diagnostic]
+    ) -> ProofSucceededResult | ProofFailedResult:
+        """
+        Classifies the diagnostics of a version of the file with a proof.
+        """
         # TODO: Might have to do the "proof replacement strategy"
         # e.g. if there is a remaining open section or namespace
         # that might trigger an error here but is not really a proof error.
         # so we need to find where the proof ends.
-        proof_diagnostics = [
-            d for d in diagnostics if self.theorem_info.range.start <= d.range.end
-        ]
-        proof_sorry_diagnostics = [
-            d
-            for d in proof_diagnostics
-            if d.severity == 2 and "declaration uses 'sorry'" in d.message
-        ]
-        if len(proof_sorry_diagnostics) > 0:
+        # Classify the diagnostics in a single pass.
+        start = self.theorem_info.range.start
+        proof_diagnostics: list[Diagnostic] = []
+        has_error = False
+        has_sorry = False
+        for d in diagnostics:
+            if d.range.end < start:
+                continue
+            proof_diagnostics.append(d)
+            if d.severity == 1:
+                has_error = True
+            elif d.severity == 2 and "declaration uses 'sorry'" in d.message:
+                has_sorry = True
+
+        if has_sorry:
             """
             Here the proof failed because it used 'sorry'.
             So the prefix including the last sorry can be learned.
             """
             return ProofFailedResult(diagnostics=proof_diagnostics)
 
-        proof_error_diagnostics = [d for d in proof_diagnostics if d.severity == 1]
-        if len(proof_error_diagnostics) == 0:
+        if not has_error:
             return ProofSucceededResult()
         else:
             return ProofFailedResult(diagnostics=proof_diagnostics)
 
+    def check_proofs(
+        self, proofs: list[str], timeout: float = 10.0
+    ) -> list[ProofSucceededResult | ProofFailedResult]:
+        """
+        Checks each proof in turn, returning results aligned with proofs.
+        Duplicate proofs are only checked once.
+
+        The proofs are not streamed into the file as successive versions:
+        Lean cancels elaboration of a version as soon as a newer one arrives,
+        so the diagnostics of all but the last version would be incomplete.
+        """
+        results: dict[str, ProofSucceededResult | ProofFailedResult] = {}
+        for proof in proofs:
+            if proof not in results:
+                results[proof] = self.check_proof(proof, timeout)
+        return [results[proof] for proof in proofs]
+
     def __enter__(self):
         return self
 
@@ -270,5 +466,5 @@ class Harness:
         exc_value: Optional[BaseException],
         traceback: Optional[types.TracebackType],
     ) -> Optional[bool]:
-        self.client.shutdown()
+        self.release_client()
         return None
@@ -7,22 +7,23 @@ It would likely be better to integrate them into the language server
 """
 
 import json
+from dataclasses import dataclass
 from pathlib import Path
 import subprocess
+import threading
 
-from pydantic import BaseModel
+import orjson
 
 from lean_client.client import TheoremInfo, ProofSampleArguments
 
 
 def run_command(
     workspace: Path, command: str, args: list[str]
-) -> subprocess.CompletedProcess[str]:
+) -> subprocess.CompletedProcess[bytes]:
     result = subprocess.run(
         ["lake", "exe", "llm-instruments", command] + args,
         cwd=workspace,
         capture_output=True,
-        text=True,
     )
     return result
 
@@ -31,7 +32,24 @@ class CommandError(Exception):
     pass
 
 
-class HeartbeatCommand(BaseModel):
+# Resolved workspaces on which the heartbeat command has succeeded. Support for
+# the instruments does not go away while we are running, so each workspace
+# only needs to pay for the lake startup once.
+HEARTBEAT_WORKSPACES: set[Path] = set()
+
+# Results of TheoremInfoCommand keyed by (resolved workspace, relative file,
+# command args). Each entry holds the file mtime in ns it was computed at and
+# the theorem infos, both as returned and grouped by theorem name. Editing the
+# file changes its mtime, so the next run replaces the entry.
+TheoremInfoKey = tuple[Path, Path, tuple[str, ...]]
+TheoremInfoIndex = dict[str, list[TheoremInfo]]
+TheoremInfoEntry = tuple[int, list[TheoremInfo], TheoremInfoIndex]
+THEOREM_INFO_CACHE: dict[TheoremInfoKey, TheoremInfoEntry] = {}
+THEOREM_INFO_CACHE_LOCK = threading.Lock()
+
+
+@dataclass
+class HeartbeatCommand:
     workspace: Path  # Root of Lean project
 
     def __post_init__(self):
@@ -50,11 +68,18 @@ class HeartbeatCommand(BaseModel):
         Returns True if the heartbeat command succeeds
         Returns False otherwise
         """
+        workspace = self.workspace.resolve()
+        if workspace in HEARTBEAT_WORKSPACES:
+            return True
         result = run_command(self.workspace, self.command_name, self.command_args)
-        return result.returncode == 0
+        if result.returncode != 0:
+            return False
+        HEARTBEAT_WORKSPACES.add(workspace)
+        return True
 
 
-class TheoremInfoCommand(BaseModel):
+@dataclass
+class TheoremInfoCommand:
     workspace: Path  # Root of Lean project
     rel_filepath: Path  # Relative to workspace root
     samples: list[ProofSampleArguments]
@@ -79,7 +104,54 @@ class TheoremInfoCommand(BaseModel):
         return args
 
     def run(self) -> list[TheoremInfo] | CommandError:
-        result = run_command(self.workspace, self.command_name, self.command_args)
+        """
+        Returns the theorem infos of the file. Results are cached until the
+        file is modified, so Harnesses for different theorems of the same file
+        only run the command once.
+        """
+        result = self._run_cached()
+        if isinstance(result, CommandError):
+            return result
+        theorem_infos, _ = result
+        return list(theorem_infos)
+
+    def run_indexed(self) -> TheoremInfoIndex | CommandError:
+        """
+        Like run, but groups the theorem infos by name for direct lookup. The
+        grouping is cached along with the infos, and the returned dict is shared
+        with the cache, so it must not be modified.
+        """
+        result = self._run_cached()
+        if isinstance(result, CommandError):
+            return result
+        _, indexed = result
+        return indexed
+
+    def _run_cached(
+        self,
+    ) -> tuple[list[TheoremInfo], TheoremInfoIndex] | CommandError:
+        command_args = self.command_args
+        cache_key = (self.workspace.resolve(), self.rel_filepath, tuple(command_args))
+        mtime_ns = self.file_path.stat().st_mtime_ns
+        with THEOREM_INFO_CACHE_LOCK:
+            cached = THEOREM_INFO_CACHE.get(cache_key)
+        if cached is not None and cached[0] == mtime_ns:
+            _, theorem_infos, indexed = cached
+            return theorem_infos, indexed
+        result = run_command(self.workspace, self.command_name, command_args)
         if result.returncode != 0:
-            return CommandError(f"TheoremInfoCommand failed: {result.stderr}")
-        return [TheoremInfo.from_lean_dict(item) for item in json.loads(result.stdout)]
+            stderr = result.stderr.decode("utf-8", errors="replace")
+            return CommandError(f"TheoremInfoCommand failed: {stderr}")
+        # The output is parsed straight from the captured bytes.
+        theorem_infos = [
+            TheoremInfo.from_lean_dict(item) for item in orjson.loads(result.stdout)
+        ]
+        indexed: TheoremInfoIndex = {}
+        for theorem_info in theorem_infos:
+            indexed.setdefault(theorem_info.name, []).append(theorem_info)
+        with THEOREM_INFO_CACHE_LOCK:
+            # Don't replace a result for a newer version of the file.
+            cached = THEOREM_INFO_CACHE.get(cache_key)
+            if cached is None or cached[0] <= mtime_ns:
+                THEOREM_INFO_CACHE[cache_key] = (mtime_ns, theorem_infos, indexed)
+        return theorem_infos, indexed
@@ -1,14 +1,52 @@
 from dataclasses import dataclass
+from functools import lru_cache
 from typing import Optional
 from lean_client.client import Range, Position
 
 
 def get_range_str(content: str, r: Range) -> str:
-    lines = content.split("\n")
-    line_slice = lines[r.start.line: r.end.line + 1].copy()
-    line_slice[-1] = line_slice[-1][: r.end.character]
-    line_slice[0] = line_slice[0][r.start.character:]
-    return "\n".join(line_slice)
+    # Only the lines up to the end of the range (and the start of the next
+    # one, to clamp the end character) need to be located.
+    line_offsets = build_line_offsets(content, r.end.line + 2)
+    return get_range_str_indexed(content, line_offsets, r)
+
+
+def build_line_offsets(content: str, max_lines: Optional[int] = None) -> list[int]:
+    """
+    Returns the offset in content at which each line starts, stopping after
+    max_lines lines if given. Build this once for contents that ranges are
+    repeatedly extracted from.
+    """
+    offsets = [0]
+    find = content.find
+    i = find("\n")
+    while i != -1 and (max_lines is None or len(offsets) < max_lines):
+        offsets.append(i + 1)
+        i = find("\n", i + 1)
+    return offsets
+
+
+def pos_to_offset(content: str, line_offsets: list[int], pos: Position) -> int:
+    """
+    Converts a position to an offset in content, clamping the line to the
+    last line and the character to the end of its line.
+    """
+    line = min(pos.line, len(line_offsets) - 1)
+    if line + 1 < len(line_offsets):
+        line_end = line_offsets[line + 1] - 1
+    else:
+        line_end = len(content)
+    return min(line_offsets[line] + pos.character, line_end)
+
+
+def get_range_str_indexed(content: str, line_offsets: list[int], r: Range) -> str:
+    """
+    Same as get_range_str, but uses the line offsets of content (from
+    build_line_offsets) instead of splitting it.
+    """
+    start = pos_to_offset(content, line_offsets, r.start)
+    end = pos_to_offset(content, line_offsets, r.end)
+    return content[start:end]
 
 
 def str_to_pos(s: str) -> Position:
@@ -24,6 +62,19 @@ def str_to_pos(s: str) -> Position:
     return Position(line=end_line, character=end_char)
 
 
+def str_end_pos(start: Position, s: str) -> Position:
+    """
+    Returns the ending position of s when it begins at start. Equivalent to
+    str_to_pos(prefix + s) where prefix ends at start, without needing prefix.
+    """
+    num_newlines = s.count("\n")
+    if num_newlines == 0:
+        return Position(line=start.line, character=start.character + len(s))
+    return Position(
+        line=start.line + num_newlines, character=len(s) - s.rfind("\n") - 1
+    )
+
+
 @dataclass
 class ParseResult:
     parsed: str
@@ -36,10 +87,12 @@ def consume_whitespace(s: str) -> ParseResult:
     return ParseResult(parsed=stripped_space, rest=stripped_string)
 
 
+@lru_cache(maxsize=4096)
 def parse_lean_docstring(s: str) -> Optional[str]:
     """
     Parses lean docstring (i.e. /-- docstring -/)
     Consumes leading and trailing whitespace
+    Results are memoized, since the same signatures are parsed repeatedly.
     """
     whitespace = consume_whitespace(s)
     if not whitespace.rest.startswith("/--"):
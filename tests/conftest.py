@@ -1,66 +1,285 @@
+import hashlib
+import os
 import pytest
 import shutil
 import subprocess
+import threading
 import logging
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
+from typing import Iterator, Optional
 
-from tests.util import INSTR_PROJ_LOC, NO_INSTR_PROJ_LOC, BuildError
+from filelock import FileLock
+
+from lean_client.client import LeanClient, get_server_path
+from lean_client.harness import Harness
+from tests.util import (
+    INSTR_PROJ_LOC,
+    NO_INSTR_PROJ_LOC,
+    BuildError,
+    DummyClient,
+    read_instr_file,
+)
 
 logger = logging.getLogger(__name__)
 
 
+# The `lake update` arguments and `lake build` targets of each test project.
+PROJECTS: dict[Path, tuple[list[str], list[str]]] = {
+    INSTR_PROJ_LOC: (
+        ["«llm-instruments»"],
+        ["«llm-instruments»", "llm-instruments-server"],
+    ),
+    NO_INSTR_PROJ_LOC: ([], []),
+}
+
+# An output of each project's `lake build`; a project without it is unbuilt.
+BUILD_ARTIFACTS: dict[Path, Path] = {
+    INSTR_PROJ_LOC: get_server_path(INSTR_PROJ_LOC),
+    NO_INSTR_PROJ_LOC: NO_INSTR_PROJ_LOC / ".lake" / "build",
+}
+
+
+def needs_update(loc: Path) -> bool:
+    """
+    Whether the lake manifest of the project is missing or older than its
+    lakefile. Otherwise `lake build` fetches what the manifest pins.
+    """
+    manifest = loc / "lake-manifest.json"
+    if not manifest.is_file():
+        return True
+    manifest_mtime = manifest.stat().st_mtime
+    for name in ("lakefile.lean", "lakefile.toml"):
+        lakefile = loc / name
+        if lakefile.is_file() and lakefile.stat().st_mtime > manifest_mtime:
+            return True
+    return False
+
+
+def get_build_steps(loc: Path) -> list[list[str]]:
+    """
+    Returns the lake commands that build the project, in order. All targets
+    are built by one `lake build` so the dependency graph is resolved once.
+    """
+    update_args, build_targets = PROJECTS[loc]
+    steps: list[list[str]] = []
+    if needs_update(loc):
+        steps.append(["lake", "update", *update_args])
+    steps.append(["lake", "build", *build_targets])
+    return steps
+
+
+# The files that determine the outcome of building a test project.
+BUILD_INPUTS = [
+    "lakefile.lean",
+    "lakefile.toml",
+    "lean-toolchain",
+    "lake-manifest.json",
+]
+
+
+def build_inputs_digest(loc: Path) -> str:
+    """
+    Returns a hash of the build inputs of the project at loc.
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    for name in BUILD_INPUTS:
+        path = loc / name
+        if path.is_file():
+            digest.update(name.encode())
+            digest.update(path.read_bytes())
+    return digest.hexdigest()
+
+
+def build_changed_projects(cache_dir: Optional[Path]) -> None | BuildError:
+    """
+    Builds the projects whose build inputs changed since they were last built
+    successfully. The digest of each successful build is recorded in
+    cache_dir, a directory of the pytest cache (None if it is disabled).
+    """
+
+    def is_up_to_date(loc: Path) -> bool:
+        if cache_dir is None or not BUILD_ARTIFACTS[loc].exists():
+            return False
+        digest_file = cache_dir / loc.name
+        if not digest_file.is_file():
+            return False
+        return digest_file.read_text() == build_inputs_digest(loc)
+
+    to_build = [loc for loc in PROJECTS if not is_up_to_date(loc)]
+    if not to_build:
+        logger.info("[Fixture] Test projects are up to date")
+        return None
+    build_error = build_in_parallel(to_build)
+    if build_error is None and cache_dir is not None:
+        for loc in to_build:
+            # Digest after building, since `lake update` rewrites the manifest.
+            (cache_dir / loc.name).write_text(build_inputs_digest(loc))
+    return build_error
+
+
+# How much of a failed lake step's output to include in its BuildError.
+BUILD_OUTPUT_TAIL = 4096
+
+# Serializes builds of the same project within this process.
+BUILD_LOCKS = {loc: threading.Lock() for loc in PROJECTS}
+
+
+def build_project(loc: Path) -> None | BuildError:
+    """
+    Runs the build steps of the project in order.
+    """
+    with BUILD_LOCKS[loc]:
+        for step in get_build_steps(loc):
+            logger.info(f"[Fixture] Running {' '.join(step)} in {loc}")
+            # Lake's output is only shown if the step fails.
+            result = subprocess.run(step, cwd=loc, capture_output=True, text=True)
+            if result.returncode == 0:
+                continue
+            output = (result.stdout + result.stderr)[-BUILD_OUTPUT_TAIL:]
+            if step[1] == "update":
+                return BuildError(
+                    f"Failed to update Lake dependencies in {loc}:\n{output}"
+                )
+            return BuildError(f"Failed to build Lean project at {loc}:\n{output}")
+    return None
+
+
+def build_in_parallel(locs: list[Path]) -> None | BuildError:
+    """
+    Builds the projects concurrently; they are independent of each other.
+    Returns the first error, after every build has finished.
+    """
+    with ThreadPoolExecutor(max_workers=len(locs)) as executor:
+        futures = [executor.submit(build_project, loc) for loc in locs]
+        errors = [future.result() for future in as_completed(futures)]
+    return next((error for error in errors if error is not None), None)
+
+
+# Remembers where lake was found. Environment variables set before xdist
+# spawns its workers are inherited by them, so they skip the PATH search.
+LAKE_PATH_ENV = "_LAKE_PATH"
+
+
+def find_lake() -> Optional[str]:
+    """
+    Returns the path of the lake executable, or None if it is not on PATH.
+    """
+    path = os.environ.get(LAKE_PATH_ENV)
+    if path and os.access(path, os.X_OK):
+        return path
+    path = shutil.which("lake")
+    if path is not None:
+        os.environ[LAKE_PATH_ENV] = path
+    return path
+
+
+def pytest_configure(config: pytest.Config) -> None:
+    # Runs in the xdist controller before the workers are started.
+    find_lake()
+
+
 @pytest.fixture(scope="session")
 def lake_available() -> bool:
     """Check if 'lake' is available in the system PATH."""
-    return shutil.which("lake") is not None
+    return find_lake() is not None
 
 
 @pytest.fixture(scope="session")
-def build_instr_proj(lake_available: bool) -> None | BuildError:
+def build_projects(
+    lake_available: bool,
+    tmp_path_factory: pytest.TempPathFactory,
+    pytestconfig: pytest.Config,
+) -> None:
+    """
+    Build test Lean projects using 'lake'. Skips the dependent tests if lake
+    is not available, and fails them if the build fails.
+    """
     if not lake_available:
-        return BuildError("Lake is not available in the system PATH.")
-    logger.info(f"[Fixture] Updating llm-instruments for {INSTR_PROJ_LOC}")
-    update_result = subprocess.run(
-        ["lake", "update", "«llm-instruments»"], cwd=INSTR_PROJ_LOC
-    )
-    if update_result.returncode != 0:
-        return BuildError(f"Failed to update Lake dependencies in {INSTR_PROJ_LOC}")
-
-    logger.info(f"[Fixture] Building llm-instruments for {INSTR_PROJ_LOC}")
-    build_result = subprocess.run(
-        ["lake", "build", "«llm-instruments»"], cwd=INSTR_PROJ_LOC
-    )
-    if build_result.returncode != 0:
-        return BuildError(f"Failed to build Lean project at {INSTR_PROJ_LOC}")
-    logger.info(f"[Fixture] Building llm-instruments-server for {INSTR_PROJ_LOC}")
-    build_result = subprocess.run(
-        ["lake", "build", "llm-instruments-server"], cwd=INSTR_PROJ_LOC
-    )
-    if build_result.returncode != 0:
-        return BuildError(f"Failed to build Lean project at {INSTR_PROJ_LOC}")
+        pytest.skip("lake not available on PATH")
+    build_error = build_once(tmp_path_factory, pytestconfig)
+    if build_error is not None:
+        pytest.fail(str(build_error))
+
+
+def build_once(
+    tmp_path_factory: pytest.TempPathFactory, pytestconfig: pytest.Config
+) -> None | BuildError:
+    # The cache is missing when pytest runs with -p no:cacheprovider.
+    cache: Optional[pytest.Cache] = getattr(pytestconfig, "cache", None)
+    cache_dir = cache.mkdir("lean_build") if cache is not None else None
+    if "PYTEST_XDIST_WORKER" not in os.environ:
+        return build_changed_projects(cache_dir)
+
+    # Under pytest-xdist every worker runs session fixtures. The first worker
+    # to take the lock builds the projects and records the outcome; the others
+    # wait for it and reuse the outcome.
+    shared_tmp_dir = tmp_path_factory.getbasetemp().parent
+    result_file = shared_tmp_dir / "lean-build-result"
+    with FileLock(str(result_file) + ".lock"):
+        if result_file.is_file():
+            error = result_file.read_text()
+            return BuildError(error) if error else None
+        build_error = build_changed_projects(cache_dir)
+        result_file.write_text("" if build_error is None else str(build_error))
+        return build_error
 
 
 @pytest.fixture(scope="session")
-def build_no_instr_proj(lake_available: bool) -> None | BuildError:
-    if not lake_available:
-        return BuildError("Lake is not available in the system PATH.")
-    logger.info(f"[Fixture Updating {NO_INSTR_PROJ_LOC}]")
-    update_result = subprocess.run(["lake", "update"], cwd=NO_INSTR_PROJ_LOC)
-    if update_result.returncode != 0:
-        return BuildError(f"Failed to update Lake dependencies in {NO_INSTR_PROJ_LOC}")
+def instr_files() -> dict[str, str]:
+    """
+    The Lean sources of the instr project, keyed by their path relative to
+    the project, read once for the session.
+    """
+    return {
+        relpath: read_instr_file(relpath)
+        for relpath in (
+            path.relative_to(INSTR_PROJ_LOC).as_posix()
+            for path in INSTR_PROJ_LOC.glob("LeanInstrProj/*.lean")
+        )
+    }
+
 
-    logger.info(f"[Fixture] Building no-instruct proj for {INSTR_PROJ_LOC}")
-    build_result = subprocess.run(["lake", "build"], cwd=NO_INSTR_PROJ_LOC)
-    if build_result.returncode != 0:
-        return BuildError(f"Failed to build Lean project at {NO_INSTR_PROJ_LOC}")
+@pytest.fixture(scope="session")
+def dummy_client() -> Iterator[DummyClient]:
+    """A plain Lean server on the current directory, shared by the session."""
+    # Without a lakefile the client runs `lean --server` directly.
+    if shutil.which("lean") is None:
+        pytest.skip("lean not available on PATH")
+    with DummyClient() as dc:
+        yield dc
 
 
 @pytest.fixture(scope="session")
-def build_projects(
-    build_instr_proj: None | BuildError, build_no_instr_proj: None | BuildError
-) -> None | BuildError:
-    """Build test Lean projects using 'lake' if available."""
-    if build_instr_proj is not None:
-        return build_instr_proj
-    if build_no_instr_proj is not None:
-        return build_no_instr_proj
-    return None
+def instr_client(build_projects: None) -> Iterator[LeanClient]:
+    """An instrumented client on the instr project, shared by the session."""
+    with LeanClient.start(INSTR_PROJ_LOC, instrument_server=True, timeout=30) as client:
+        yield client
+
+
+def make_harness(relfile: Path, theorem_name: str) -> Iterator[Harness]:
+    with Harness(
+        workspace=INSTR_PROJ_LOC, relfile=relfile, theorem_name=theorem_name
+    ) as harness:
+        yield harness
+
+
+@pytest.fixture(scope="session")
+def harness_foo(build_projects: None) -> Iterator[Harness]:
+    """
+    A harness for the theorem:
+    theorem foo : True := by sorry
+    """
+    yield from make_harness(Path("LeanInstrProj/Harness.lean"), "foo")
+
+
+@pytest.fixture(scope="session")
+def harness_bat(build_projects: None) -> Iterator[Harness]:
+    """
+    A harness for the theorem:
+    namespace Cat
+
+    theorem bat (a b : Nat) : a + b = b + a := by
+      sorry
+    """
+    yield from make_harness(Path("LeanInstrProj/Harness.lean"), "Cat.bat")
@@ -1,14 +1,16 @@
-from typing import Optional
-from dataclasses import dataclass
-from pathlib import Path
 import logging
+import sys
 from typing import Any
 
 import pytest
-from tests.util import INSTR_PROJ_LOC
+from tests.util import INSTR_PROJ_URI, DummyClient
 
 from lean_client.client import (
     LeanClient,
+    DiagnosticsNotification,
+    LeanProgressNotification,
+    Position,
+    Range,
     WaitForDiagnosticsRequest,
     WaitForDiagnosticsResponse,
     FindTheoremsRequest,
@@ -17,90 +19,136 @@ from lean_client.client import (
     FindTheoremsResponse,
 )
 
-from tests.util import BuildError
-
 logger = logging.getLogger(__name__)
 
 
-DUMMY_TEXT = """
-theorem foo : True := by
-    cases
-
-def bar : Nat := 0
-"""
-
-
-@dataclass
-class DummyClient:
-    def __init__(self):
-        self.client = LeanClient.start(
-            self.workspace, instrument_server=False, timeout=30
+def test_position_order() -> None:
+    a = Position(line=1, character=5)
+    b = Position(line=2, character=0)
+    assert a < b and a <= b and not b < a and not b <= a
+    assert a <= Position(line=1, character=5) and not a < Position(line=1, character=5)
+    assert a < Position(line=1, character=6)
+    assert a.max(b) == b and b.max(a) == b
+
+
+def test_range_from_str() -> None:
+    assert Range.from_str("21:17-21:31") == Range(Position(21, 17), Position(21, 31))
+    for s in ["21:17", "1_0:2-3:4", " 1:2-3:4", "+1:2-3:4", "1:2-3:-4"]:
+        with pytest.raises(ValueError):
+            Range.from_str(s)
+
+
+def test_range_predicates() -> None:
+    outer = Range.from_str("1:0-5:0")
+    inner = Range.from_str("2:3-4:1")
+    assert outer.subsumes(inner) and not inner.subsumes(outer)
+    assert outer.intersect(inner) and inner.intersect(outer)
+    assert not Range.from_str("0:0-1:0").intersect(outer)
+    assert Range.from_str("0:0-1:0").immediately_before(outer)
+    assert Range.from_str("0:0-0:4").immediately_before(Range.from_str("1:0-1:2"))
+    assert not Range.from_str("0:0-0:4").immediately_before(inner)
+
+
+def test_diagnostics_notification_from_response() -> None:
+    r = {"start": {"line": 1, "character": 0}, "end": {"line": 1, "character": 4}}
+    message = {
+        "method": "textDocument/publishDiagnostics",
+        "params": {
+            "uri": "file:///test.lean",
+            "version": 3,
+            "diagnostics": [
+                {"severity": 1, "range": r, "fullRange": r, "message": "error"}
+            ],
+        },
+    }
+    notification = DiagnosticsNotification.from_response(message)
+    assert notification.version == 3
+    (diagnostic,) = notification.diagnostics
+    assert diagnostic.source is None
+    assert diagnostic.range == Range.from_str("1:0-1:4")
+    assert notification.diagnostics is notification.diagnostics
+
+
+def test_progress_notification_done() -> None:
+    def progress(processing: list[Any]) -> LeanProgressNotification:
+        return LeanProgressNotification.from_response(
+            {
+                "method": "$/lean/fileProgress",
+                "params": {
+                    "textDocument": {"uri": "file:///test.lean", "version": 2},
+                    "processing": processing,
+                },
+            }
         )
 
-    @property
-    def workspace(self) -> Path:
-        return Path.cwd().resolve()
-
-    @property
-    def root_uri(self) -> str:
-        return Path.cwd().resolve().as_uri()
+    r = {"start": {"line": 0, "character": 0}, "end": {"line": 3, "character": 0}}
+    assert not progress([{"range": r, "kind": 1}]).done
+    assert progress([]).done
 
-    @property
-    def dummy_file(self) -> Path:
-        return Path("test.lean").resolve()
 
-    @property
-    def dummy_uri(self) -> str:
-        return self.dummy_file.as_uri()
+@pytest.mark.needs_lean
+def test_find_theorems_request(dummy_client: DummyClient):
+    dc = dummy_client
+    version = dc.set_dummy_text()
+    wait_request = WaitForDiagnosticsRequest(uri=dc.dummy_uri, version=version)
+    wait_response = dc.client.send_request(wait_request)
+    assert isinstance(wait_response, WaitForDiagnosticsResponse)
 
-    def __enter__(self) -> "DummyClient":
-        return self
 
-    def __exit__(self, exc_type: Any, exc_value: Any, traceback: Any) -> None:
-        self.client.shutdown()
-
-
-def test_find_theorems_request():
-    with DummyClient() as dc:
-        dc.client.open_file(dc.dummy_uri, DUMMY_TEXT)
-        wait_request = WaitForDiagnosticsRequest(
-            uri=dc.dummy_uri, version=dc.client.file_version(dc.dummy_uri)
+@pytest.mark.needs_lean
+def test_send_request_async(dummy_client: DummyClient):
+    dc = dummy_client
+    version = dc.set_dummy_text()
+    futures = [
+        dc.client.send_request_async(
+            WaitForDiagnosticsRequest(uri=dc.dummy_uri, version=version)
         )
-        wait_response = dc.client.send_request(wait_request)
-        assert isinstance(wait_response, WaitForDiagnosticsResponse)
-
-
-def test_batteries_document_symbol_request(build_projects: Optional[BuildError]):
-    if build_projects is not None:
-        pytest.fail(str(build_projects))
-
-    # uri = INSTR_PROJ_LOC.resolve().as_uri()
-    with LeanClient.start(INSTR_PROJ_LOC, instrument_server=True, timeout=30) as client:
-        file = INSTR_PROJ_LOC / "LeanInstrProj" / "BatteryStuff.lean"
-        # file = INSTR_PROJ_LOC / "LeanInstrProj" / "Harness.lean"
-        file_uri = file.resolve().as_uri()
-        client.open_file(file_uri, file.read_text())
-        wait_request = WaitForDiagnosticsRequest(
-            uri=file_uri, version=client.file_version(file_uri)
-        )
-        wait_response = client.send_request(wait_request)
-        assert isinstance(wait_response, WaitForDiagnosticsResponse)
-        diags = client.latest_diagnostics[file_uri]
-        print(f"Diagnostics: {diags.diagnostics}")
-        request = FindTheoremsRequest(uri=file_uri)
-        response = client.send_request(request)
-        assert isinstance(response, FindTheoremsResponse)
-        assert len(response.theorems) == 1
-        assert response.theorems[0].name == "rat_to_float"
-
-        request = FindDeclsRequest(uri=file_uri)
-        response = client.send_request(request)
-        assert isinstance(response, FindDeclsResponse)
-        assert len(response.decls) == 1
+        for _ in range(3)
+    ]
+    for future in futures:
+        assert isinstance(future.result(timeout=30), WaitForDiagnosticsResponse)
+    assert dc.client.latest_diagnostics[dc.dummy_uri].version == version
+
+
+@pytest.mark.needs_lean
+def test_cancel_request_async(dummy_client: DummyClient):
+    dc = dummy_client
+    version = dc.set_dummy_text()
+    request = WaitForDiagnosticsRequest(uri=dc.dummy_uri, version=version)
+    cancelled = dc.client.send_request_async(request)
+    cancelled.cancel()
+    # The response to the cancelled request must not stop the client.
+    assert isinstance(dc.client.send_request(request), WaitForDiagnosticsResponse)
+    assert isinstance(dc.client.send_request(request), WaitForDiagnosticsResponse)
+
+
+@pytest.mark.needs_lean
+def test_batteries_document_symbol_request(
+    instr_client: LeanClient, instr_files: dict[str, str]
+):
+    client = instr_client
+    file = "LeanInstrProj/BatteryStuff.lean"
+    # file = "LeanInstrProj/Harness.lean"
+    file_uri = f"{INSTR_PROJ_URI}/{file}"
+    client.open_file(file_uri, instr_files[file])
+    wait_request = WaitForDiagnosticsRequest(
+        uri=file_uri, version=client.file_version(file_uri)
+    )
+    wait_response = client.send_request(wait_request)
+    assert isinstance(wait_response, WaitForDiagnosticsResponse)
+    diags = client.latest_diagnostics[file_uri]
+    print(f"Diagnostics: {diags.diagnostics}")
+    request = FindTheoremsRequest(uri=file_uri)
+    response = client.send_request(request)
+    assert isinstance(response, FindTheoremsResponse)
+    assert len(response.theorems) == 1
+    assert response.theorems[0].name == "rat_to_float"
+
+    request = FindDeclsRequest(uri=file_uri)
+    response = client.send_request(request)
+    assert isinstance(response, FindDeclsResponse)
+    assert len(response.decls) == 1
 
 
 if __name__ == "__main__":
-    import logging
-
-    logging.basicConfig(level=logging.INFO)
-    test_batteries_document_symbol_request(None)
+    sys.exit(pytest.main([__file__, "-x", "--lf"] + sys.argv[1:]))
@@ -1,13 +1,12 @@
-from typing import Optional
+import sys
+
 import pytest
 import textwrap
-from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
 from pydantic import BaseModel
 
 from lean_client.harness import Harness, ProofSucceededResult, ProofFailedResult
 
-from tests.util import INSTR_PROJ_LOC, BuildError
-
 
 class Foo(BaseModel):
     result: ProofSucceededResult | ProofFailedResult
@@ -29,14 +28,12 @@ def test_serialize_proof_result() -> None:
     assert isinstance(parsed_result2.result, ProofSucceededResult)
 
 
-def test_proof_foo_result(build_projects: Optional[BuildError]) -> None:
+@pytest.mark.needs_lean
+def test_proof_foo_result(harness_foo: Harness) -> None:
     """
     Tests proofs for the theorem:
     theorem foo : True := by sorry
     """
-    if build_projects is not None:
-        pytest.fail(str(build_projects))
-
     proof_trivial = " := by trivial"
 
     proof_simp = """ := by
@@ -54,27 +51,54 @@ def test_proof_foo_result(build_projects: Optional[BuildError]) -> None:
     """
     proof_contradiction = textwrap.dedent(proof_contradiction)
 
-    with Harness(
-        workspace=INSTR_PROJ_LOC,
-        relfile=Path("LeanInstrProj/Harness.lean"),
-        theorem_name="foo",
-    ) as harness:
-        assert harness.orig_file_contents.endswith("theorem foo : True := by sorry\n")
-
-        result_trivial = harness.check_proof(proof_trivial)
-        assert isinstance(result_trivial, ProofSucceededResult)
-
-        result_simp = harness.check_proof(proof_simp)
-        assert isinstance(result_simp, ProofSucceededResult)
-
-        result_sorry = harness.check_proof(proof_sorry)
-        assert isinstance(result_sorry, ProofFailedResult)
-
-        result_contradiction = harness.check_proof(proof_contradiction)
-        assert isinstance(result_contradiction, ProofFailedResult)
-
-
-def test_proof_bat_result(build_projects: Optional[BuildError]) -> None:
+    harness = harness_foo
+    assert harness.orig_file_contents.endswith("theorem foo : True := by sorry\n")
+
+    proofs = [proof_trivial, proof_simp, proof_sorry, proof_contradiction]
+    results = harness.check_proofs(proofs)
+    result_trivial, result_simp, result_sorry, result_contradiction = results
+    assert isinstance(result_trivial, ProofSucceededResult)
+    assert isinstance(result_simp, ProofSucceededResult)
+    assert isinstance(result_sorry, ProofFailedResult)
+    assert isinstance(result_contradiction, ProofFailedResult)
+
+
+@pytest.mark.needs_lean
+def test_check_proof_async(harness_foo: Harness) -> None:
+    harness = harness_foo
+    proofs = [" := by trivial", " := by\n  sorry\n", " := by\n  contradiction\n"]
+    expected = [ProofSucceededResult, ProofFailedResult, ProofFailedResult]
+    for proof, result_type in zip(proofs, expected):
+        # Checks on the same file are made one at a time.
+        future = harness.check_proof_async(proof)
+        result = future.result(timeout=30)
+        assert isinstance(result, result_type)
+        assert result == harness.check_proof(proof)
+
+
+@pytest.mark.needs_lean
+def test_concurrent_checks_on_one_file(
+    harness_foo: Harness, harness_bat: Harness
+) -> None:
+    # Both harnesses share the document of Harness.lean.
+    checks: list[tuple[Harness, str, type]] = [
+        (harness_foo, " := by trivial", ProofSucceededResult),
+        (harness_bat, " := by trivial", ProofFailedResult),
+        (harness_foo, " := by contradiction", ProofFailedResult),
+        (harness_bat, " := by omega", ProofSucceededResult),
+    ] * 3
+
+    def check(harness: Harness, proof: str, result_type: type) -> None:
+        assert isinstance(harness.check_proof(proof), result_type)
+
+    with ThreadPoolExecutor(max_workers=len(checks)) as executor:
+        futures = [executor.submit(check, *c) for c in checks]
+        for future in futures:
+            future.result()
+
+
+@pytest.mark.needs_lean
+def test_proof_bat_result(harness_bat: Harness) -> None:
     """
     Tests proofs for the theorem:
     namespace Cat
@@ -82,9 +106,6 @@ def test_proof_bat_result(build_projects: Optional[BuildError]) -> None:
     theorem bat (a b : Nat) : a + b = b + a := by
       sorry
     """
-    if build_projects is not None:
-        pytest.fail(str(build_projects))
-
     proof_trivial = " := by trivial"
 
     proof_omega = """ := by
@@ -92,30 +113,19 @@ def test_proof_bat_result(build_projects: Optional[BuildError]) -> None:
     """
     proof_omega = textwrap.dedent(proof_omega)
 
-    with Harness(
-        workspace=INSTR_PROJ_LOC,
-        relfile=Path("LeanInstrProj/Harness.lean"),
-        theorem_name="Cat.bat",
-    ) as harness:
-        print("harness initialized")
-        result_trivial = harness.check_proof(proof_trivial)
-        assert isinstance(result_trivial, ProofFailedResult)
-        error_messages = [
-            d.message for d in result_trivial.diagnostics if d.severity == 1
-        ]
-        assert len(error_messages) > 0
-
-        result_omega = harness.check_proof(proof_omega)
-        assert isinstance(result_omega, ProofSucceededResult)
-        assert (
-            harness.get_full_theorem_signature()
-            == "theorem bat (a b : Nat) : a + b = b + a"
-        )
-        assert harness.get_type_signature() == "(a b : Nat) : a + b = b + a"
+    harness = harness_bat
+    result_trivial, result_omega = harness.check_proofs([proof_trivial, proof_omega])
+    assert isinstance(result_trivial, ProofFailedResult)
+    error_messages = [d.message for d in result_trivial.diagnostics if d.severity == 1]
+    assert len(error_messages) > 0
 
+    assert isinstance(result_omega, ProofSucceededResult)
+    assert (
+        harness.get_full_theorem_signature()
+        == "theorem bat (a b : Nat) : a + b = b + a"
+    )
+    assert harness.get_type_signature() == "(a b : Nat) : a + b = b + a"
 
-if __name__ == "__main__":
-    import logging
 
-    logging.basicConfig(level=logging.DEBUG)
-    test_proof_bat_result(None)
+if __name__ == "__main__":
+    sys.exit(pytest.main([__file__, "-x", "--lf"] + sys.argv[1:]))
@@ -1,7 +1,8 @@
+import sys
+
 import pytest
 
-from typing import Optional
-from tests.util import INSTR_PROJ_LOC, NO_INSTR_PROJ_LOC, BuildError
+from tests.util import INSTR_PROJ_LOC, NO_INSTR_PROJ_LOC
 from pathlib import Path
 
 from lean_client.client import Range, ProofSampleArguments
@@ -11,25 +12,20 @@ from lean_client.instruments import (
     CommandError,
 )
 
+pytestmark = pytest.mark.needs_lean
+
 
-def test_instr_heartbeat_success(build_projects: Optional[BuildError]) -> None:
-    if build_projects is not None:
-        pytest.fail(str(build_projects))
+def test_instr_heartbeat_success(build_projects: None) -> None:
     cmd = HeartbeatCommand(workspace=INSTR_PROJ_LOC)
     assert cmd.run() is True
 
 
-def test_instr_heartbeat_failure(build_projects: Optional[BuildError]) -> None:
-    if build_projects is not None:
-        pytest.fail(str(build_projects))
+def test_instr_heartbeat_failure(build_projects: None) -> None:
     cmd = HeartbeatCommand(workspace=NO_INSTR_PROJ_LOC)
     assert cmd.run() is False
 
 
-def test_theorem_info(build_projects: Optional[BuildError]) -> None:
-    if build_projects is not None:
-        pytest.fail(str(build_projects))
-
+def test_theorem_info(build_projects: None) -> None:
     samples = [
         ProofSampleArguments.depth(0.25),
         ProofSampleArguments.depth(0.5),
@@ -77,4 +73,4 @@ def test_theorem_info(build_projects: Optional[BuildError]) -> None:
 
 
 if __name__ == "__main__":
-    pytest.main([__file__])
+    sys.exit(pytest.main([__file__, "-x", "--lf"] + sys.argv[1:]))
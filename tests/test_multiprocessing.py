@@ -1,22 +1,60 @@
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Iterator
+
+import pytest
+
 from lean_client.client import (
     LeanClient,
     WaitForDiagnosticsRequest,
     WaitForDiagnosticsResponse,
 )
 
-from tests.util import INSTR_PROJ_LOC
+from tests.util import INSTR_PROJ_LOC, INSTR_PROJ_URI
+
+pytestmark = pytest.mark.needs_lean
+
+NUM_CLIENTS = 2
+
+# Clients started by the tests in this module, by workspace. Shut down when
+# the module finishes.
+CLIENT_CACHE: dict[Path, list[LeanClient]] = {}
+
 
+def get_clients(workspace: Path) -> list[LeanClient]:
+    """
+    Returns NUM_CLIENTS clients on the workspace, starting them in parallel
+    the first time.
+    """
+    clients = CLIENT_CACHE.get(workspace)
+    if clients is None:
+        with ThreadPoolExecutor(max_workers=NUM_CLIENTS) as executor:
+            clients = list(executor.map(LeanClient.start, [workspace] * NUM_CLIENTS))
+        CLIENT_CACHE[workspace] = clients
+    return clients
 
-def test_parallel_clients() -> None:
-    NUM_CLIENTS = 2
+
+@pytest.fixture(scope="module", autouse=True)
+def shutdown_clients() -> Iterator[None]:
+    yield
+    with ThreadPoolExecutor(max_workers=NUM_CLIENTS) as executor:
+        for clients in CLIENT_CACHE.values():
+            list(executor.map(LeanClient.shutdown, clients))
+    CLIENT_CACHE.clear()
+
+
+def test_parallel_clients(build_projects: None, instr_files: dict[str, str]) -> None:
     file = "LeanInstrProj/TheoremRanges.lean"
-    file_uri = (INSTR_PROJ_LOC / file).resolve().as_uri()
-    file_contents = (INSTR_PROJ_LOC / file).read_text()
-    clients = [LeanClient.start(INSTR_PROJ_LOC) for _ in range(NUM_CLIENTS)]
-    for client in clients:
+    file_uri = f"{INSTR_PROJ_URI}/{file}"
+    file_contents = instr_files[file]
+
+    def check_file(client: LeanClient) -> None:
         client.open_file(file_uri, file_contents)
         request = WaitForDiagnosticsRequest(
             uri=file_uri, version=client.file_version(file_uri)
         )
         assert isinstance(client.send_request(request), WaitForDiagnosticsResponse)
-        client.shutdown()
+
+    clients = get_clients(INSTR_PROJ_LOC)
+    with ThreadPoolExecutor(max_workers=NUM_CLIENTS) as executor:
+        list(executor.map(check_file, clients))
@@ -1,4 +1,12 @@
-from lean_client.lsp_utils import parse_lean_docstring
+from lean_client.client import Range
+from lean_client.lsp_utils import (
+    build_line_offsets,
+    get_range_str,
+    get_range_str_indexed,
+    parse_lean_docstring,
+    str_end_pos,
+    str_to_pos,
+)
 
 
 def test_parse_lean_docstring() -> None:
@@ -27,3 +35,29 @@ def test_parse_lean_docstring() -> None:
 
     unclosed_docstring = "/--\nThis is an unclosed docstring"
     assert parse_lean_docstring(unclosed_docstring) is None
+
+
+def test_get_range_str() -> None:
+    content = "theorem foo :\n  True := by\n  trivial\n"
+    line_offsets = build_line_offsets(content)
+    assert line_offsets == [0, 14, 27, 37]
+    assert build_line_offsets(content, 2) == [0, 14]
+    expected = {
+        "0:0-1:6": "theorem foo :\n  True",
+        "0:8-0:11": "foo",
+        "1:2-2:9": "True := by\n  trivial",
+        "0:0-3:0": content,
+        "1:0-1:99": "  True := by",
+        "1:2-9:4": "True := by\n  trivial\n",
+    }
+    for range_str, range_text in expected.items():
+        r = Range.from_str(range_str)
+        assert get_range_str(content, r) == range_text
+        assert get_range_str_indexed(content, line_offsets, r) == range_text
+
+
+def test_str_end_pos() -> None:
+    prefix = "import Foo\n\ntheorem "
+    start = str_to_pos(prefix)
+    for s in ["", "foo", "/--\ndoc\n-/\n", "a\nbc"]:
+        assert str_end_pos(start, s) == str_to_pos(prefix + s)
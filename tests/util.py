@@ -1,8 +1,60 @@
+from functools import lru_cache
 from pathlib import Path
+from typing import Any
+
+from lean_client.client import LeanClient
 
 INSTR_PROJ_LOC = Path("tests/test-data/lean-instr-proj")
 NO_INSTR_PROJ_LOC = Path("tests/test-data/lean-no-instr-proj")
+INSTR_PROJ_URI = INSTR_PROJ_LOC.resolve().as_uri()
+
+
+@lru_cache(maxsize=None)
+def read_instr_file(relpath: str) -> str:
+    """Contents of a file in the instrumented project; read once per process."""
+    return (INSTR_PROJ_LOC / relpath).read_text()
 
 
 class BuildError(Exception):
     pass
+
+
+# Contents for the dummy client's scratch file.
+DUMMY_TEXT = """
+theorem foo : True := by
+    cases
+
+def bar : Nat := 0
+"""
+
+
+class DummyClient:
+    """
+    A plain (non-instrumented) Lean server on the current directory, with a
+    scratch test.lean file to open.
+    """
+
+    def __init__(self):
+        self.workspace = Path.cwd().resolve()
+        self.root_uri = self.workspace.as_uri()
+        self.dummy_file = self.workspace / "test.lean"
+        self.dummy_uri = self.dummy_file.as_uri()
+        self.client = LeanClient.start(
+            self.workspace, instrument_server=False, timeout=30
+        )
+
+    def set_dummy_text(self, text: str = DUMMY_TEXT) -> int:
+        """
+        Opens the scratch file with text, or changes it to text if an earlier
+        test already opened it. Returns the new version of the file.
+        """
+        if not self.client.is_open(self.dummy_uri):
+            self.client.open_file(self.dummy_uri, text)
+            return self.client.file_version(self.dummy_uri)
+        return self.client.change_file(self.dummy_uri, text)
+
+    def __enter__(self) -> "DummyClient":
+        return self
+
+    def __exit__(self, exc_type: Any, exc_value: Any, traceback: Any) -> None:
+        self.client.shutdown()